@@ -1,10 +1,10 @@
 import argparse
-import io
 import json
+import sqlite3
 import sys
 import singer
 
-from jsonschema import ValidationError
+from jsonschema import SchemaError, ValidationError
 from sqlalchemy.exc import DatabaseError
 
 from target_sqlite.target_sqlite import TargetSQLite
@@ -23,6 +23,9 @@ def process_input(config, lines):
 
     Loop through the lines sent in sys.stdin, process each one and run DDL and
     batch DML operations.
+
+    The lines can be either str or (UTF-8 encoded) bytes, as the JSON decoder
+    accepts both.
     """
     target = TargetSQLite(config)
 
@@ -51,8 +54,8 @@ def main_implementation():
         raise Exception("Config is missing required keys: {}".format(missing_keys))
 
     # Run the Input processing loop until everything is done
-    input = io.TextIOWrapper(sys.stdin.buffer, encoding="utf-8")
-    process_input(config, input)
+    # The raw lines are passed to the JSON decoder, without decoding them to str
+    process_input(config, sys.stdin.buffer)
 
     LOGGER.debug("Exiting normally")
 
@@ -61,7 +64,13 @@ def main():
     try:
         # wrap the real main() and catch exceptions we want to handle somehow
         main_implementation()
-    except (ValidationError, DatabaseError, SchemaUpdateError) as exc:
+    except (
+        ValidationError,
+        SchemaError,
+        DatabaseError,
+        sqlite3.DatabaseError,
+        SchemaUpdateError,
+    ) as exc:
         for line in str(exc).splitlines():
             LOGGER.critical(line)
         sys.exit(1)
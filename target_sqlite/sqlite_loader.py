@@ -1,10 +1,12 @@
+import functools
 import logging
 from pathlib import Path
 
-from typing import Dict, List
-from sqlalchemy import create_engine, inspect, Table, text
+from typing import Dict, List, Sequence, Tuple, Union
+from sqlalchemy import bindparam, create_engine, func, inspect, Table, text
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.engine import Engine
 from sqlalchemy.event import listen
-from sqlalchemy import exc
 
 
 # Map sqlalchemy types to SQLite Types
@@ -20,42 +22,147 @@ MAP_SQLALCHEMY_TO_SQLITE_TYPE = {
     "TIMESTAMP": "TEXT",
 }
 
+# Page size used for newly created databases (it can not be changed once
+#  a table exists or the database is in WAL mode)
+PAGE_SIZE = 8192
+
+# Settings applied to every connection opened to the database, in order to
+#  speed up bulk loading data:
+# + synchronous=NORMAL is safe in WAL mode; it only skips the fsync per COMMIT
+# + Keep temporary tables and indices in memory
+# + Allow up to 256 MiB for the page cache and for memory mapped I/O
+# + Checkpoint the WAL every 10000 pages instead of every 1000
+CONNECTION_PRAGMAS = [
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-262144",
+    "PRAGMA mmap_size=268435456",
+    "PRAGMA wal_autocheckpoint=10000",
+]
+
+
+def enable_wal(conn, conn_record):
+    cursor = conn.cursor()
+
+    # The page size must be set before the journal mode is switched to WAL
+    #  and only takes effect on a database without any tables
+    cursor.execute("SELECT COUNT(*) FROM sqlite_master")
+    if cursor.fetchone()[0] == 0:
+        cursor.execute(f"PRAGMA page_size={PAGE_SIZE}")
+
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.close()
+
+
+def set_pragmas(conn, conn_record):
+    cursor = conn.cursor()
+    for pragma in CONNECTION_PRAGMAS:
+        cursor.execute(pragma)
+    cursor.close()
+
+
+def get_database_path(config: Dict) -> Union[Path, str]:
+    """
+    Get the path of the SQLite database defined by the "database" in config
+
+    A name is stored in a file.db, while an SQLite URI filename (starting
+    with "file:", e.g. "file:my_db?mode=memory&cache=shared" for a shared
+    in memory database) is used as it is.
+    """
+    database = config["database"]
+    if database.startswith("file:"):
+        return database
+
+    return Path(database).with_suffix(".db")
+
+
+@functools.lru_cache(maxsize=None)
+def get_engine(database_path: Union[Path, str]) -> Engine:
+    """
+    Get the Engine for the SQLite database stored in database_path
+
+    A single Engine (and connection pool) is created for each database and
+    shared by the SQLiteLoaders of all the streams loaded to it.
+    """
+    url = f"sqlite:///{database_path}"
+    if isinstance(database_path, str) and database_path.startswith("file:"):
+        # Let sqlite3 open the database as an URI filename
+        url += "&uri=true" if "?" in database_path else "?uri=true"
+
+    engine = create_engine(url, future=True)
+    listen(engine, "first_connect", enable_wal)
+    listen(engine, "connect", set_pragmas)
+
+    return engine
+
 
 class SQLiteLoader:
     def __init__(self, table: Table, config: Dict) -> None:
         self.table = table
-        self.database_path = Path(config["database"]).with_suffix(".db")
+        self.database_path = get_database_path(config)
 
-        self.engine = create_engine(f"sqlite:///{self.database_path}", future=True)
-        listen(self.engine, "first_connect", self.enable_wal)
+        self.engine = get_engine(self.database_path)
 
-    def enable_wal(cls, conn, conn_record):
-        cursor = conn.cursor()
-        cursor.execute("PRAGMA journal_mode=WAL")
-        cursor.close()
+        # The attribute(column) names of the Table, in the order the values of
+        #  each row loaded are bound to the INSERT statement
+        self._col_names = tuple(column.name for column in self.table.columns)
 
-    def attribute_names(self) -> List[str]:
+        # Build the INSERT (or UPSERT for tables with a primary key) statement
+        #  once and compile it to SQL with positional parameters, so that it can
+        #  be reused for every batch loaded to the table
+        if self.table.primary_key:
+            statement = self.upsert_statement()
+        else:
+            statement = self.table.insert().values(self.insert_values())
+
+        self._insert_sql = str(statement.compile(dialect=self.engine.dialect))
+
+    def attribute_names(self) -> Tuple[str, ...]:
         """
         Get the attribute(column) names for the associated Table
         """
-        return [column.name for column in self.table.columns]
+        return self._col_names
 
-    def empty_record(self) -> Dict:
+    def insert_values(self) -> Dict:
         """
-        Get a dictionary representing an empty (all attributes None) record for
-        the table associated with this SQLiteLoader instance.
+        Get the values to INSERT for each column of self.table
 
-        Used as a template in order to normalize (map) all imported records to
-        the full schema they are defined for.
+        Each value is bound to a parameter, but columns with a server default
+        fall back to it when a NULL value is provided for them. This way the
+        default is evaluated by SQLite even for tables created before it was
+        defined (e.g. the timestamp of when the record was loaded).
+        """
+        values = {}
+        for column in self.table.columns:
+            value = bindparam(column.name)
+            if column.server_default is not None:
+                value = func.coalesce(value, column.server_default.arg)
+            values[column.name] = value
 
-        Important for records with multiple optional attributes that are not
-        always there, like for example Multi Level JSON objects that are
-        flattened before uploaded to SQLite.
+        return values
 
-        Guards against sqlalchemy errors for missing required values for
-        bind parameters.
+    def upsert_statement(self):
         """
-        return dict.fromkeys(column.name for column in self.table.columns)
+        Generate an INSERT .. ON CONFLICT DO UPDATE statement for self.table
+
+        All the attributes that are not part of the primary key are updated
+        with the values of the conflicting row (SQLite's `excluded` table).
+        """
+        statement = sqlite_insert(self.table).values(self.insert_values())
+        index_elements = [column.name for column in self.table.primary_key]
+        update_columns = {
+            column.name: statement.excluded[column.name]
+            for column in self.table.columns
+            if column.name not in index_elements
+        }
+
+        if not update_columns:
+            # Nothing to update if all the attributes are part of the key
+            return statement.on_conflict_do_nothing(index_elements=index_elements)
+
+        return statement.on_conflict_do_update(
+            index_elements=index_elements, set_=update_columns
+        )
 
     def schema_apply(self) -> None:
         """
@@ -80,8 +187,26 @@ class SQLiteLoader:
         1. Only support type upgrades (e.g. STRING -> VARCHAR) for existing columns
         2. If a not supported type update is requested (e.g. float --> int)
            raise a SchemaUpdateError exception.
-        2. Never drop columns, only update or add new ones
+        3. Never drop columns, only update or add new ones
+        4. Rows are UPSERTed on the primary key of the existing table, so it
+           must match the one of the new Table. Otherwise (e.g. the table was
+           created before the stream had key properties), records are loaded
+           with a plain INSERT instead.
         """
+        table_pk = [column.name for column in self.table.primary_key]
+        existing_pk = inspector.get_pk_constraint(self.table.name)[
+            "constrained_columns"
+        ]
+
+        if table_pk and set(table_pk) != set(existing_pk):
+            logging.warning(
+                f"Table {self.table.name} already exists with primary key "
+                f"{existing_pk}, which does not match the key properties "
+                f"{table_pk}: records are INSERTed instead of UPSERTed"
+            )
+            statement = self.table.insert().values(self.insert_values())
+            self._insert_sql = str(statement.compile(dialect=self.engine.dialect))
+
         existing_columns = {}
         columns_to_add = []
 
@@ -102,47 +227,53 @@ class SQLiteLoader:
                 columns_to_add.append((column.name, column_type))
 
         # If there are any columns to add, make the schema update
-        for name, type in columns_to_add:
-            self.add_column(name, type)
+        #  in a single transaction
+        if columns_to_add:
+            with self.engine.begin() as connection:
+                for name, type in columns_to_add:
+                    self._add_column(connection, name, type)
 
-    def add_column(self, col_name: str, col_data_type: str) -> None:
+    def _add_column(self, connection, col_name: str, col_data_type: str) -> None:
         """
         Add the requested column to the SQLite Table defined by self.table
+
+        The ALTER TABLE is executed in the transaction of the given connection
         """
         full_name = self.table.name
         alter_stmt = f"ALTER TABLE {full_name} ADD COLUMN {col_name} {col_data_type}"
 
         logging.debug(f"Adding COLUMN {col_name} ({col_data_type}) to {full_name}")
 
-        with self.engine.begin() as connection:
-            connection.execute(text(alter_stmt))
+        connection.execute(text(alter_stmt))
 
-    def load(self, data: List[Dict]) -> None:
+    def load(self, data: List[Sequence]) -> None:
         """
-        Load the data provided as a list of dictionaries to the given Table
+        Load the data provided as a list of rows to the given Table
+
+        Each row is a sequence (e.g. a tuple or a list) with a value for each
+        attribute, in the same order as attribute_names()
         """
         if not data:
             return
 
         logging.debug(f"Loading data to SQLite for {self.table.name}")
-        if self.table.primary_key:
-            # We have to use SQLite's Upsert but the default SQLite for python
-            #  does not yet support the "ON CONFLICT" clause for upserting
-            # So, we'll follow the slow but stable approach of inserting each
-            #  row and updating on conflict.
-            with self.engine.begin() as connection:
-                for row in data:
-                    try:
-                        connection.execute(self.table.insert(), row)
-                    except exc.IntegrityError:
-                        statement = self.table.update()  # .where()
-                        for primary_key in self.table.primary_key:
-                            statement = statement.where(
-                                primary_key == row[primary_key.name]
-                            )
-
-                        connection.execute(statement, row)
-        else:
-            # Just Insert (append) as no conflicts can arise
-            with self.engine.begin() as connection:
-                connection.execute(self.table.insert(), data)
+
+        # Send all the rows in one executemany() call directly to the sqlite3
+        #  connection, skipping sqlalchemy's per row overhead. For tables with
+        #  a primary key, rows are UPSERTed by using SQLite's
+        #  INSERT .. ON CONFLICT clause (requires SQLite 3.24+)
+        connection = self.engine.raw_connection()
+        try:
+            cursor = connection.cursor()
+            # Take the write lock when the transaction starts, instead of
+            #  upgrading a deferred transaction at the first INSERT
+            cursor.execute("BEGIN IMMEDIATE")
+            cursor.executemany(self._insert_sql, data)
+            cursor.close()
+            connection.commit()
+        except Exception:
+            connection.rollback()
+            raise
+        finally:
+            # Return the connection to the engine's pool
+            connection.close()
@@ -1,43 +1,47 @@
 import json
+import operator
 import singer
 import sys
 
-from datetime import datetime, timezone
+from collections import deque
+
 from jsonschema import ValidationError, Draft4Validator, FormatChecker
-from typing import Dict, List, Iterator
+from typing import Callable, Dict, List, Iterator, Optional, Union
 
+from target_sqlite.utils.json_utils import loads
 from target_sqlite.utils.singer_target_utils import (
-    flatten_record,
+    compile_record_flattener,
     flatten_key,
     generate_sqlalchemy_table,
+    schema_cache_key,
+    simple_record_check,
 )
 from target_sqlite.sqlite_loader import SQLiteLoader
 
 
 LOGGER = singer.get_logger()
 
+# Loading thousands of rows per executemany() call is where SQLite's insert
+#  throughput levels off, while the cached records still fit easily in memory
+DEFAULT_BATCH_SIZE = 5000
 
-class RecordBuffer(list):
-    def add_record(self, record: Dict):
-        self.append(record)
-
-    def values(self):
-        return self
-
+# Validators memoized by the content of their JSON Schema, so that SCHEMA
+#  messages sent again for the same stream (or identical schemas for
+#  different streams or Targets) reuse an already checked validator
+_validator_cache: Dict[bytes, Draft4Validator] = {}
 
-class UniqueRecordBuffer(dict):
-    def __init__(self, key_func=lambda x: x):
-        self.key = key_func
 
-    def add_record(self, record: Dict):
-        self[self.key(record)] = record
+def line_text(line: Union[str, bytes]) -> str:
+    """
+    Get the text of a line read from stdin, for logging and error messages
 
-    def values(self):
-        return list(super().values())
+    Lines are read as bytes, so they are only decoded when they have to be
+    reported (replacing any invalid UTF-8) instead of showing their repr.
+    """
+    if isinstance(line, bytes):
+        return line.decode("utf-8", errors="replace")
 
-    def __iter__(self):
-        for record in self.values():
-            yield record
+    return line
 
 
 class StateBuffer:
@@ -61,22 +65,34 @@ class StateBuffer:
     Those are streams that can be safely flushed to stdout and, following the
     Singer.io specification, we flush only the most recent one, as it should
     have the most up to date information on the state of the Tap.
+
+    In order to not go through all the stored STATE messages on each flush,
+    we also keep for each stream the STATE messages that are waiting for it.
+    As the unflushed streams of a STATE message are always a subset of the
+    ones of any STATE message that arrives after it, the STATE messages
+    without unflushed streams are always the oldest ones in the buffer.
     """
 
     def __init__(self) -> None:
-        self.buffer = []
+        self.buffer = deque()
+        self._state_refs: Dict = {}
 
     def add_state(self, state: str, streams: List) -> None:
         LOGGER.debug(f"StateBuffer: new state stored {state}: {streams}")
-        self.buffer.append({"state": state, "streams": streams})
+        entry = {"state": state, "pending": set(streams)}
+        self.buffer.append(entry)
+
+        for stream in entry["pending"]:
+            self._state_refs.setdefault(stream, []).append(entry)
 
     def flush_stream(self, stream: str) -> None:
-        for state in self.buffer:
-            state["streams"] = [x for x in state["streams"] if x != stream]
+        for entry in self._state_refs.pop(stream, ()):
+            entry["pending"].discard(stream)
 
     def pop_states_without_streams(self) -> List[str]:
-        states = [state["state"] for state in self.buffer if not state["streams"]]
-        self.buffer = [state for state in self.buffer if state["streams"]]
+        states = []
+        while self.buffer and not self.buffer[0]["pending"]:
+            states.append(self.buffer.popleft()["state"])
         return states
 
     def __iter__(self):
@@ -85,12 +101,19 @@ class StateBuffer:
 
 
 class TargetSQLite:
-    def __init__(self, config: Dict) -> None:
+    def __init__(
+        self, config: Dict, state_listener: Optional[Callable[[Dict], None]] = None
+    ) -> None:
         # Store the Config so that we can use it to initiate SQLite Loaders
         #  for various tables
         self.config: Dict = config
-        self.batch_size = int(config.get("batch_size", 50))
+
+        # Emitted states are written to stdout, unless a state_listener is
+        #  given to be called with each of them instead (e.g. in tests)
+        self.state_listener = state_listener
+        self.batch_size = int(config.get("batch_size", DEFAULT_BATCH_SIZE))
         self.timestamp_column = config.get("timestamp_column", "__loaded_at")
+        self.fast_validation = config.get("fast_validation", True)
 
         # Store all the state messages in a State Buffer, so that we can flush
         #  them to stdout the moment all their relevant streams are flushed
@@ -107,17 +130,26 @@ class TargetSQLite:
         self.schemas: List = []
         self.loaders: Dict = {}
 
-        # Also keep track of a template empty record for each stream in order
-        #  to map all incoming records against and normalize them to use their
-        #  fully defined schema
-        self.template_records: Dict = {}
+        # Also keep track of the order of the columns of each stream's Table.
+        # All incoming records are normalized to a list with a value for each
+        #  column in that order (None for missing attributes), which is the
+        #  order the SQLiteLoader binds the values of each row.
+        self._col_order: Dict = {}
+
+        # A function extracting the values of the key_properties from those
+        #  lists, for each stream with key_properties
+        self._key_fn: Dict = {}
 
-        # Finaly, keep the attributes of the database Table associated with
-        #  each stream for quick lookups.
-        # It is used while flattening records in order to know when an attribute
-        #  is defined as an Object (i.e. semistructured data type) and its values
-        #  must be stored as they are without further unnesting them.
-        self.entity_attributes: Dict = {}
+        # Whether each stream has key_properties, in which case its records
+        #  are cached in a dict (keyed by them) instead of a list
+        self._has_pk: Dict = {}
+
+        # Finaly, keep a function for flattening the records of each stream.
+        # It is generated from the stream's JSON Schema and the attributes of
+        #  the database Table associated with the stream, so it knows which
+        #  attributes are defined as an Object (i.e. semistructured data type)
+        #  and their values must be stored as they are without unnesting them.
+        self._flatteners: Dict = {}
 
         # The key_properties has the keys for each stream to enable quick
         #  lookups during schema validation of each received record
@@ -128,6 +160,15 @@ class TargetSQLite:
         #  new records against
         self.validators: Dict = {}
 
+        # For streams with a simple JSON Schema (only types of top level
+        #  properties and required ones), keep a fast check that records must
+        #  pass before falling back to the full validator
+        self._fast_checks: Dict = {}
+
+        # The required top level properties of each stream, checked before the
+        #  full validator so that records missing any of them fail right away
+        self._required_keys: Dict = {}
+
         # Cache the records for each stream in rows[stream]
         # When the cache reaches the batch_size or when the tap stops
         #  sending data, we flush the cached records (i.e. send them in batch to
@@ -135,27 +176,32 @@ class TargetSQLite:
         #  an insert with each record received.
         self.rows: Dict = {}
 
-    def extract_keys(self, stream: str, record: Dict):
-        return tuple(record[key] for key in self.key_properties[stream])
+        # Keep track of the streams that have records cached since they were
+        #  last flushed, so that they can be found without checking the cached
+        #  records of every stream. A dict is used as an insertion ordered set,
+        #  so that the streams are always flushed in the same order.
+        self._dirty_streams: Dict = {}
 
-    def process_line(self, line: str) -> None:
+    def process_line(self, line: Union[str, bytes]) -> None:
         """
         Process a Singer.io Message, which is provided in a single line
         """
         try:
-            o = json.loads(line)
+            o = loads(line)
         except json.decoder.JSONDecodeError:
-            LOGGER.error("Unable to parse:\n{}".format(line))
+            LOGGER.error("Unable to parse:\n{}".format(line_text(line)))
             raise
 
         if "type" not in o:
-            raise Exception("Line is missing required key 'type': {}".format(line))
+            raise Exception(
+                "Line is missing required key 'type': {}".format(line_text(line))
+            )
         t = o["type"]
 
         if t == "RECORD":
             if "stream" not in o:
                 raise Exception(
-                    "Line is missing required key 'stream': {}".format(line)
+                    "Line is missing required key 'stream': {}".format(line_text(line))
                 )
 
             stream = o["stream"]
@@ -171,35 +217,36 @@ class TargetSQLite:
                 stream, o["record"], self.key_properties[stream]
             )
 
-            # Add an `timestamp_column` timestamp for the record
-            if self.timestamp_column not in flat_record:
-                flat_record[self.timestamp_column] = datetime.now(tz=timezone.utc)
-
             # Normalize the record to make sure it follows the full schema defined
-            new_record = self.template_records[stream].copy()
-            new_record.update(flat_record)
+            # The `timestamp_column` is left None, unless it is in the record,
+            #  and SQLite sets it to the time the record is loaded.
+            new_record = [flat_record.get(c) for c in self._col_order[stream]]
 
             # Store the record so that we can load in batch_size batches
-            self.rows[stream].add_record(new_record)
+            if self._has_pk[stream]:
+                self.rows[stream][self._key_fn[stream](new_record)] = new_record
+            else:
+                self.rows[stream].append(new_record)
+
+            self._dirty_streams[stream] = None
 
             # If the batch_size has been reached for this stream, flush the records
             if len(self.rows[stream]) >= self.batch_size:
                 self.flush_records(stream)
         elif t == "STATE":
             new_state = o["value"]
-            unflushed_streams = list(self.streams_with_unflushed_records())
-
-            if unflushed_streams:
+            if self._dirty_streams:
                 # There are unflushed streams --> store the STATE message in StateBuffer
-                self.states.add_state(new_state, unflushed_streams)
+                self.states.add_state(new_state, list(self._dirty_streams))
             else:
                 # All streams are clean, no cached records at the moment
                 # Just send the STATE message directly to stdout
                 self.emit_state(new_state)
+                sys.stdout.flush()
         elif t == "SCHEMA":
             if "stream" not in o:
                 raise Exception(
-                    "Line is missing required key 'stream': {}".format(line)
+                    "Line is missing required key 'stream': {}".format(line_text(line))
                 )
 
             stream = o["stream"]
@@ -211,7 +258,7 @@ class TargetSQLite:
             #  the relational table to be created.
             if "properties" not in o["schema"]:
                 raise ValidationError(
-                    f"Not supported schema by target-sqlite:\n {line}\n"
+                    f"Not supported schema by target-sqlite:\n {line_text(line)}\n"
                     "It should at least have one top level property in schema."
                 )
 
@@ -227,9 +274,10 @@ class TargetSQLite:
                 self.schemas.append(stream)
 
             # Add a validator based on the received JSON Schema
-            self.validators[stream] = Draft4Validator(
-                o["schema"], format_checker=FormatChecker()
-            )
+            self.validators[stream] = self.get_validator(o["schema"])
+            if self.fast_validation:
+                self._fast_checks[stream] = simple_record_check(o["schema"])
+                self._required_keys[stream] = tuple(o["schema"].get("required", ()))
 
             # We could live without it for append only use cases without a key,
             #  but it is part of the Singer.io SPEC
@@ -237,7 +285,7 @@ class TargetSQLite:
                 raise Exception("key_properties field is required")
 
             # We have to process the `key_properties` like all columns
-            key_properties = [flatten_key(prop, [], "") for prop in o["key_properties"]]
+            key_properties = [flatten_key(prop, (), "") for prop in o["key_properties"]]
 
             # Store the Key properties for quick lookups during record validation
             self.key_properties[stream] = key_properties
@@ -249,6 +297,17 @@ class TargetSQLite:
                 stream, key_properties, o["schema"], self.timestamp_column
             )
 
+            # All the key properties must be columns, as records are buffered
+            #  and UPSERTed by them (e.g. an anyOf definition is not a column)
+            missing_keys = [
+                key for key in key_properties if key not in sqlalchemy_table.c
+            ]
+            if missing_keys:
+                raise ValidationError(
+                    f"Key properties {missing_keys} of stream {stream} are not "
+                    "columns of its schema"
+                )
+
             # Create a SQLiteLoader for that sqlalchemy Table and
             #  run schema_apply() to create the Schema and/or Table if they
             #  are not there.
@@ -258,37 +317,62 @@ class TargetSQLite:
                 loader.schema_apply()
             except Exception as exc:
                 LOGGER.error(
-                    "Exception in schema_apply() while prrocessing:\n{}".format(line)
+                    "Exception in schema_apply() while prrocessing:\n{}".format(
+                        line_text(line)
+                    )
                 )
                 raise exc
 
-            # This buffering makes sure that if we receive multiple rows that
+            # Buffering the records of streams with `key_properties` in a dict
+            #  keyed by them makes sure that if we receive multiple rows that
             #  would violate the `key_properties` uniqueness,
             #  only the last one will be kept.
-            if key_properties:
-                self.rows[stream] = UniqueRecordBuffer(
-                    lambda record: self.extract_keys(stream, record)
-                )
-            else:
-                self.rows[stream] = RecordBuffer()
+            self._has_pk[stream] = bool(key_properties)
+            self.rows[stream] = {} if key_properties else []
 
-            # Keep a template empty record for each stream in order to map
+            # Keep the column order for each stream in order to map
             #  all incoming records against
-            self.template_records[stream] = loader.empty_record()
+            col_order = loader.attribute_names()
+            self._col_order[stream] = col_order
+            if key_properties:
+                # For a single key the itemgetter returns its value instead of
+                #  a tuple, which works just as well as a key for the cache
+                self._key_fn[stream] = operator.itemgetter(
+                    *(col_order.index(key) for key in key_properties)
+                )
 
             # Keep the loader in loaders[stream] to be used for loading the
             #  records received for this stream.
             self.loaders[stream] = loader
 
-            # And also keep the attributes of the database Table associated
-            #  with this stream
-            self.entity_attributes[stream] = loader.attribute_names()
+            # And also generate the function for flattening this stream's records
+            self._flatteners[stream] = compile_record_flattener(
+                o["schema"], loader.attribute_names()
+            )
         elif t == "ACTIVATE_VERSION":
             # No support for that type of message yet
             LOGGER.warn("ACTIVATE_VERSION message")
         else:
             LOGGER.warn("Skipping unknown message type {}.".format(o["type"]))
 
+    def get_validator(self, schema: Dict) -> Draft4Validator:
+        """
+        Get a Draft4Validator for the given JSON Schema
+
+        The schema is checked against the Draft4 metaschema only once, when
+        its validator is first created, and the validator is shared by all
+        the Targets in the process.
+        """
+        cache_key = schema_cache_key(schema)
+
+        validator = _validator_cache.get(cache_key)
+        if validator is None:
+            Draft4Validator.check_schema(schema)
+            validator = Draft4Validator(schema, format_checker=FormatChecker())
+            _validator_cache[cache_key] = validator
+
+        return validator
+
     def validate_record(self, stream: str, record: Dict, keys: List) -> Dict:
         """
         Validate a record against the schema for its stream
@@ -300,8 +384,18 @@ class TargetSQLite:
 
         Returns the flattened record ready for integration
         """
-        self.validators[stream].validate(record)
-        flat_record = flatten_record(record, self.entity_attributes[stream])
+        fast_check = self._fast_checks.get(stream)
+        if fast_check is None or not fast_check(record):
+            if isinstance(record, dict):
+                for key in self._required_keys.get(stream, ()):
+                    if key not in record:
+                        raise ValidationError(f"{key!r} is a required property")
+
+            error = next(self.validators[stream].iter_errors(record), None)
+            if error is not None:
+                raise error
+
+        flat_record = self._flatteners[stream](record)
         missing_keys = [key for key in keys if key not in flat_record]
 
         if missing_keys:
@@ -316,11 +410,14 @@ class TargetSQLite:
         Flush the records for any remaining streams that still have
         records cached (i.e. row_count < batch_size)
         """
-        to_flush = self.streams_with_unflushed_records()
+        to_flush = list(self.streams_with_unflushed_records())
 
         for stream in to_flush:
             self.flush_records(stream)
 
+        # Make sure that any STATE message written is sent before exiting
+        sys.stdout.flush()
+
     def flush_records(self, stream: str) -> None:
         """
         Flush the cached records stored in rows[stream] for a specific stream.
@@ -330,10 +427,13 @@ class TargetSQLite:
         """
 
         # Load the data
-        self.loaders[stream].load(self.rows[stream].values())
+        rows = self.rows[stream]
+        values = rows if isinstance(rows, list) else list(rows.values())
+        self.loaders[stream].load(values)
 
         # Clear the cached records and reset the counter for the stream
         self.rows[stream].clear()
+        self._dirty_streams.pop(stream, None)
 
         # Mark the stream as flushed in StateBuffer
         #  and check if there are any STATE messages ready to be also flushed
@@ -341,18 +441,26 @@ class TargetSQLite:
         states_without_streams = self.states.pop_states_without_streams()
 
         if states_without_streams:
-            # Only write the most resent state
+            # Only write the most resent state and send it right away, as the
+            #  records it refers to are now stored in SQLite
             self.emit_state(states_without_streams.pop())
+            sys.stdout.flush()
 
     def emit_state(self, state) -> None:
         """
-        Emit the given state to stdout
+        Emit the given state to stdout (or to the state_listener)
+
+        stdout is not flushed here, so that callers emitting more than one
+        state at once do not pay a write syscall for each one. Flush it once
+        the states must be sent right away.
         """
         if state is not None:
-            line = json.dumps(state)
-            LOGGER.debug("Emitting state {}".format(line))
-            sys.stdout.write("{}\n".format(line))
-            sys.stdout.flush()
+            if self.state_listener is None:
+                line = json.dumps(state)
+                LOGGER.debug("Emitting state %s", line)
+                sys.stdout.write(line + "\n")
+            else:
+                self.state_listener(state)
 
             self.last_emitted_state = state
 
@@ -365,4 +473,4 @@ class TargetSQLite:
         (b) when receiving a STATE message, in order to identify 'dirty'
             streams that must be flushed before emiting the STATE to stdout.
         """
-        return (stream for (stream, rows) in self.rows.items() if len(rows))
+        return iter(self._dirty_streams)
@@ -0,0 +1,24 @@
+import json
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+# Helpers for decoding the JSON documents sent to the Target.
+# + loads(document)
+#   Uses orjson when it is installed (`pip install target-sqlite[orjson]`)
+#   and falls back to the standard library json module otherwise.
+
+
+def _loads_orjson(document):
+    try:
+        return orjson.loads(document)
+    except orjson.JSONDecodeError:
+        # orjson is stricter than the json module (e.g. it rejects NaN and
+        #  integers that do not fit in 64 bits), so give the standard
+        #  library a chance before reporting the document as invalid
+        return json.loads(document)
+
+
+loads = json.loads if orjson is None else _loads_orjson
@@ -1,11 +1,13 @@
+import functools
+import hashlib
 import inflection
-import itertools
 import json
 import logging
 import re
 from collections.abc import MutableMapping
 
-from sqlalchemy import MetaData, Table, Column
+from jsonschema import FormatChecker
+from sqlalchemy import MetaData, Table, Column, text
 from sqlalchemy.types import TIMESTAMP, Float, String, BigInteger, Boolean
 
 # Set of helper functions for flattening records and schemas.
@@ -17,92 +19,396 @@ from sqlalchemy.types import TIMESTAMP, Float, String, BigInteger, Boolean
 # + flatten_schema(json_schema_definition) --> flatten a given json schema.
 # + generate_sqlalchemy_table(stream, key_properties, json_schema, timestamp_column)
 #    --> Generate an sqlalchemy Table based on a SCHEMA message
-logger = logging.getLogger()
-logger.setLevel(logging.WARNING)
+# + compile_record_flattener(json_schema, columns)
+#    --> Generate a flatten_record function specialized for a SCHEMA message
+# + simple_record_check(json_schema)
+#    --> Generate a fast type check for records following a simple JSON schema
+logger = logging.getLogger(__name__)
+
+# Server default for the timestamp column: SQLite sets the time the record
+#  was loaded, in the same format sqlalchemy uses for storing datetimes
+LOADED_AT_DEFAULT = text("(STRFTIME('%Y-%m-%d %H:%M:%f', 'NOW'))")
+
+# The python types of the values decoded from JSON for each JSON Schema type
+JSON_SCHEMA_TYPES = {
+    "string": (str,),
+    "integer": (int,),
+    "number": (int, float),
+    "boolean": (bool,),
+    "null": (type(None),),
+    "object": (dict,),
+    "array": (list,),
+}
+
+# The JSON Schema (Draft 4) keywords that a simple schema can not use, as
+#  they require more than checking the type of each top level property
+COMPLEX_SCHEMA_KEYWORDS = {
+    "$ref",
+    "additionalItems",
+    "additionalProperties",
+    "allOf",
+    "anyOf",
+    "dependencies",
+    "enum",
+    "items",
+    "maxItems",
+    "maxLength",
+    "maxProperties",
+    "maximum",
+    "minItems",
+    "minLength",
+    "minProperties",
+    "minimum",
+    "multipleOf",
+    "not",
+    "oneOf",
+    "pattern",
+    "patternProperties",
+    "properties",
+    "required",
+    "uniqueItems",
+}
+
+
+# Patterns used for inflecting stream and attribute names to table and column names
+_CAMEL_A = re.compile(r"([A-Z]+)_([A-Z][a-z])")
+_CAMEL_B = re.compile(r"([a-z\d])_([A-Z])")
+_SPECIAL_CHARS = re.compile("[^0-9a-zA-Z_]+")
+_LOWER = re.compile(r"[a-z]")
+
+# Serializer for objects and arrays stored as they are in a column.
+# Calling the encode() of an encoder with the default settings directly
+#  produces exactly the same output as json.dumps(), without the overhead of
+#  checking its keyword arguments on every call.
+# orjson is not used here, as its compact output (no spaces after separators,
+#  no escaping of non ASCII characters) would change the stored values.
+_jdumps = json.JSONEncoder().encode
+
+# The types of the values decoded from JSON that are neither objects nor arrays
+_JSON_SCALAR_TYPES = frozenset({str, int, float, bool, type(None)})
+
+# Flattened schemas memoized by the content of their JSON schema, as taps
+#  usually send the same SCHEMA message multiple times
+_flatten_schema_cache = {}
+
+
+def schema_cache_key(json_schema):
+    """
+    Get the key to memoize anything derived from the content of json_schema
+
+    Equal schemas get the same key whatever the order of their attributes,
+    while the key is a short digest instead of the whole serialized schema.
+    """
+    return hashlib.blake2b(
+        json.dumps(json_schema, sort_keys=True).encode(), digest_size=16
+    ).digest()
 
 
 def generate_sqlalchemy_table(stream, key_properties, json_schema, timestamp_column):
-    flat_schema = flatten_schema(json_schema)
+    cache_key = schema_cache_key(json_schema)
+
+    if cache_key not in _flatten_schema_cache:
+        _flatten_schema_cache[cache_key] = flatten_schema(json_schema)
+
+    # Copy the cached flattened schema, so that it can not be changed
+    flat_schema = dict(_flatten_schema_cache[cache_key])
 
     columns = []
     for name, schema in flat_schema.items():
         pk = name in key_properties
-        column = Column(name, sqlalchemy_column_type(schema), primary_key=pk)
+        default = LOADED_AT_DEFAULT if name == timestamp_column else None
+        column = Column(
+            name, sqlalchemy_column_type(schema), primary_key=pk, server_default=default
+        )
         columns.append(column)
 
     if timestamp_column and timestamp_column not in flat_schema:
-        column = Column(timestamp_column, TIMESTAMP)
+        column = Column(timestamp_column, TIMESTAMP, server_default=LOADED_AT_DEFAULT)
         columns.append(column)
 
     # Replace all special characters and CamelCase with underscores
-    table_name = re.sub("[^0-9a-zA-Z_]+", "_", stream)
+    table_name = _SPECIAL_CHARS.sub("_", stream)
     table_name = inflection.underscore(table_name)
     table = Table(table_name, MetaData(), *columns)
 
     return table
 
 
+# Attribute names repeat in every record of a stream, so both functions that
+#  inflect them are memoized
+@functools.lru_cache(maxsize=8192)
 def inflect_column_name(name):
-    name = re.sub(r"([A-Z]+)_([A-Z][a-z])", r"\1__\2", name)
-    name = re.sub(r"([a-z\d])_([A-Z])", r"\1__\2", name)
+    name = _CAMEL_A.sub(r"\1__\2", name)
+    name = _CAMEL_B.sub(r"\1__\2", name)
     # Also replace all special characters and CamelCase with underscores
-    name = re.sub("[^0-9a-zA-Z_]+", "_", name)
+    name = _SPECIAL_CHARS.sub("_", name)
     return inflection.underscore(name)
 
 
+@functools.lru_cache(maxsize=8192)
 def flatten_key(k, parent_key, sep):
-    full_key = parent_key + [k]
+    """
+    Get the column name for attribute k nested under the parent_key attributes
+
+    parent_key must be a tuple, so that the arguments can be memoized
+    """
+    full_key = parent_key + (k,)
     inflected_key = [inflect_column_name(n) for n in full_key]
+
+    # Keep track of the length of the joined key instead of joining it again
+    #  after each reduction
+    total_len = sum(map(len, inflected_key)) + len(sep) * (len(inflected_key) - 1)
     reducer_index = 0
-    while len(sep.join(inflected_key)) >= 63 and reducer_index < len(inflected_key):
-        reduced_key = re.sub(
-            r"[a-z]", "", inflection.camelize(inflected_key[reducer_index])
-        )
-        inflected_key[reducer_index] = (
+    while total_len >= 63 and reducer_index < len(inflected_key):
+        reduced_key = _LOWER.sub("", inflection.camelize(inflected_key[reducer_index]))
+        reduced_key = (
             reduced_key if len(reduced_key) > 1 else inflected_key[reducer_index][0:3]
         ).lower()
+        total_len += len(reduced_key) - len(inflected_key[reducer_index])
+        inflected_key[reducer_index] = reduced_key
         reducer_index += 1
 
     return sep.join(inflected_key)
 
 
-def flatten_record(d, schema, parent_key=[], sep="__"):
-    items = []
-    for k, v in d.items():
-        new_key = flatten_key(k, parent_key, sep)
+def flatten_record(d, schema, parent_key=(), sep="__"):
+    items = {}
+    # Walk the nested objects depth first with an explicit stack of
+    #  (parent_key, iterator over the object's items) instead of recursing,
+    #  so that the attributes are still flattened in the order they appear in
+    #  the record and later ones win if their column names collide
+    stack = [(parent_key, iter(d.items()))]
+    while stack:
+        parent, obj_items = stack[-1]
+        for k, v in obj_items:
+            new_key = flatten_key(k, parent, sep)
+
+            # Check for the concrete types decoded from JSON first, as an
+            #  isinstance() check against an ABC is a lot slower
+            value_type = type(v)
+            is_list = value_type is list
+            is_map = value_type is dict or (
+                value_type not in _JSON_SCALAR_TYPES
+                and not is_list
+                and isinstance(v, MutableMapping)
+            )
 
-        if new_key in schema:
-            # If the attribute name (new_key) is defined in the schema
-            # Then stop un-nesting and store its values as they are even if
-            #  it is an object
-            if isinstance(v, MutableMapping) or type(v) is list:
-                items.append((new_key, json.dumps(v)))
+            if new_key in schema:
+                # If the attribute name (new_key) is defined in the schema
+                # Then stop un-nesting and store its values as they are even if
+                #  it is an object
+                if is_map or is_list:
+                    items[new_key] = _jdumps(v)
+                else:
+                    items[new_key] = v
+            elif is_map:
+                # Flatten the nested object before the rest of this one
+                stack.append((parent + (k,), iter(v.items())))
+                break
+            elif is_list:
+                items[new_key] = _jdumps(v)
             else:
-                items.append((new_key, v))
-        elif isinstance(v, MutableMapping):
-            items.extend(flatten_record(v, schema, parent_key + [k], sep=sep).items())
+                items[new_key] = v
         else:
-            items.append((new_key, json.dumps(v) if isinstance(v, list) else v))
+            stack.pop()
+    return items
+
+
+def compile_record_flattener(json_schema, columns, sep="__"):
+    """
+    Generate a function that flattens records following json_schema
+
+    The generated function returns the same columns and values as
+    flatten_record(record, columns), but as the paths to all the columns are
+    known from the schema, it is just a sequence of lookups for those paths
+    instead of a recursive walk over each record.
+
+    Records with attributes not defined in the schema can still end up in one
+    of the columns once their names are inflected (e.g. "ID" is stored in the
+    "id" column), so those are flattened by flatten_record instead.
+    """
+    lines = ["def flatten(r0):", "    flat = {}"]
+    found = set()
+    # The attribute names expected in each object of the generated paths
+    known_keys = []
+
+    def add_leaf(key, column, obj, indent):
+        # Check for the concrete types decoded from JSON first, as an
+        #  isinstance() check against an ABC is a lot slower
+        lines.extend(
+            [
+                f"{indent}if {key!r} in {obj}:",
+                f"{indent}    v = {obj}[{key!r}]",
+                f"{indent}    t = type(v)",
+                f"{indent}    if t in _SCALARS:",
+                f"{indent}        flat[{column!r}] = v",
+                f"{indent}    elif t is dict or t is list "
+                "or isinstance(v, _CONTAINERS):",
+                f"{indent}        flat[{column!r}] = _dumps(v)",
+                f"{indent}    else:",
+                f"{indent}        flat[{column!r}] = v",
+            ]
+        )
+        found.add(column)
+
+    def add_object(d, parent_key, depth):
+        obj = f"r{depth}"
+        indent = "    " * depth
+        properties = d.get("properties", {})
+        lines.append(
+            f"{indent}    if not _KNOWN_KEYS[{len(known_keys)}].issuperset({obj}):"
+        )
+        lines.append(f"{indent}        return _fallback(r0)")
+        known_keys.append(set(properties))
+        for k, v in properties.items():
+            new_key = flatten_key(k, parent_key, sep)
+
+            if new_key in columns:
+                # Store its values as they are even if it is an object
+                add_leaf(k, new_key, obj, indent + "    ")
+            elif v and "properties" in v:
+                nested = f"r{depth + 1}"
+                lines.append(f"{indent}    {nested} = {obj}.get({k!r})")
+                lines.append(
+                    f"{indent}    if type({nested}) is dict or "
+                    f"isinstance({nested}, _MAPPING):"
+                )
+                # Keeps the block valid for objects without any columns
+                add_object(v, parent_key + (k,), depth + 1)
+
+    add_object(json_schema, (), 0)
+
+    # Columns not defined in the schema (e.g. the timestamp column) can still
+    #  be sent as top level attributes of the record
+    for column in columns:
+        if column not in found:
+            add_leaf(column, column, "r0", "    ")
+            known_keys[0].add(column)
+
+    lines.append("    return flat")
+
+    column_set = frozenset(columns)
+
+    def fallback(record):
+        return {
+            column: value
+            for column, value in flatten_record(record, column_set).items()
+            if column in column_set
+        }
+
+    namespace = {
+        "_fallback": fallback,
+        "_KNOWN_KEYS": [frozenset(keys) for keys in known_keys],
+        "_dumps": _jdumps,
+        "_SCALARS": _JSON_SCALAR_TYPES,
+        "_CONTAINERS": (MutableMapping, list),
+        "_MAPPING": MutableMapping,
+    }
+    exec(compile("\n".join(lines), "<flatten_record>", "exec"), namespace)
+
+    return namespace["flatten"]
+
+
+def simple_record_check(json_schema):
+    """
+    Generate a fast check for records following a simple JSON schema
+
+    A schema is simple if it only defines the type of its top level properties
+    and which of them are required. The generated function checks just that
+    with plain python type checks, much faster than a full JSON Schema
+    validation. A record passing the check is valid, while one failing it
+    should be validated by a full validator to get the validation error.
+
+    Returns None if the schema is not simple.
+    """
+    if set(json_schema) & COMPLEX_SCHEMA_KEYWORDS - {"properties", "required"}:
+        return None
+
+    if "object" not in json_schema.get("type", "object"):
+        return None
+
+    required = tuple(json_schema.get("required", ()))
+    properties = []
+    for name, definition in json_schema.get("properties", {}).items():
+        if not isinstance(definition, dict) or "$ref" in definition:
+            return None
+
+        if set(definition) & COMPLEX_SCHEMA_KEYWORDS:
+            return None
+
+        # Formats without a checker available are not validated anyway
+        if definition.get("format") in FormatChecker.checkers:
+            return None
+
+        if "type" not in definition:
+            continue
+
+        json_types = definition["type"]
+        if isinstance(json_types, str):
+            json_types = [json_types]
+
+        if any(json_type not in JSON_SCHEMA_TYPES for json_type in json_types):
+            return None
+
+        python_types = frozenset(
+            python_type
+            for json_type in json_types
+            for python_type in JSON_SCHEMA_TYPES[json_type]
+        )
+        properties.append((name, python_types))
+
+    def check(record):
+        if type(record) is not dict:
+            return False
+
+        for name in required:
+            if name not in record:
+                return False
+
+        for name, python_types in properties:
+            if name in record and type(record[name]) not in python_types:
+                return False
+
+        return True
+
+    return check
+
+
+def flatten_schema(d, parent_key=(), sep="__"):
+    items = _flatten_schema_items(d, parent_key, sep, [])
+
+    seen = set()
+    for k, _ in items:
+        if k in seen:
+            raise ValueError("Duplicate column name produced in schema: {}".format(k))
+        seen.add(k)
+
     return dict(items)
 
 
-def flatten_schema(d, parent_key=[], sep="__"):
-    items = []
-    if "properties" in d.keys():
-        for k, v in d["properties"].items():
+def _flatten_schema_items(d, parent_key, sep, items):
+    """
+    Append the (column name, definition) pairs of the flattened schema d to
+    items and return it
+
+    Nested objects are appended to the same list, so the dict of the
+    flattened schema is only built once by flatten_schema()
+    """
+    properties = d.get("properties")
+    if properties:
+        for k, v in properties.items():
             new_key = flatten_key(k, parent_key, sep)
 
             if not v:
-                logger.warn("Empty definition for {}.".format(new_key))
+                logger.warning("Empty definition for %s.", new_key)
                 continue
 
-            if "type" in v.keys():
-                if "object" in v["type"]:
+            property_type = v.get("type")
+            if property_type is not None:
+                if "object" in property_type:
                     # Additional check that objects without properties are allowed
-                    if "properties" in v.keys():
-                        items.extend(
-                            flatten_schema(v, parent_key + [k], sep=sep).items()
-                        )
+                    if "properties" in v:
+                        _flatten_schema_items(v, parent_key + (k,), sep, items)
                     else:
                         # An object without properties (for semistructured data)
                         items.append((new_key, v))
@@ -117,34 +423,26 @@ def flatten_schema(d, parent_key=[], sep="__"):
                     property["type"] = ["null", "array"]
                     items.append((new_key, property))
 
-    def key_func(item):
-        return item[0]
-
-    sorted_items = sorted(items, key=key_func)
-    for k, g in itertools.groupby(sorted_items, key=key_func):
-        if len(list(g)) > 1:
-            raise ValueError("Duplicate column name produced in schema: {}".format(k))
-
-    return dict(sorted_items)
+    return items
 
 
 def sqlalchemy_column_type(schema_property):
     property_type = schema_property["type"]
-    property_format = schema_property["format"] if "format" in schema_property else None
+    if isinstance(property_type, str):
+        # A single type, e.g. "string" instead of ["null", "string"]
+        property_type = (property_type,)
+    types = frozenset(property_type)
+    property_format = schema_property.get("format")
 
-    if "object" in property_type:
-        return String  # OBJECT
-    elif "array" in property_type:
-        return String  # ARRAY
-    elif property_format == "date-time":
-        return String
-    elif "number" in property_type:
+    if "object" in types or "array" in types or property_format == "date-time":
+        return String  # OBJECT, ARRAY or a date-time stored as it is
+    elif "number" in types:
         return Float
-    elif "integer" in property_type and "string" in property_type:
+    elif "integer" in types and "string" in types:
         return String
-    elif "integer" in property_type:
+    elif "integer" in types:
         return BigInteger
-    elif "boolean" in property_type:
+    elif "boolean" in types:
         return Boolean
     else:
         return String
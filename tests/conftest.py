@@ -1,14 +1,15 @@
 from __future__ import annotations
 
 import json
+import os
 import pytest
 
-from collections import UserDict
+from pathlib import Path
 
 import sqlalchemy as sa
 
 
-class SilencedDict(UserDict):
+class SilencedDict(dict):
     def __repr__(self):
         return "Dict[ ... sensitive_data ... ]"
 
@@ -21,7 +22,9 @@ def pytest_addoption(parser):
 
 
 @pytest.fixture(scope="session")
-def config(request: pytest.FixtureRequest) -> SilencedDict:
+def config(
+    request: pytest.FixtureRequest, tmp_path_factory: pytest.TempPathFactory
+) -> SilencedDict:
     config = SilencedDict()
 
     config_file = request.config.getoption("--config")
@@ -34,6 +37,17 @@ def config(request: pytest.FixtureRequest) -> SilencedDict:
 
     config["timestamp_column"] = config.get("timestamp_column", "__loaded_at")
 
+    if os.environ.get("TARGET_SQLITE_TEST_INMEM", "1") != "0":
+        # Use a shared in memory database instead of a file, so that the
+        #  connections of all the tests see the same database without any I/O
+        # (set TARGET_SQLITE_TEST_INMEM=0 to test with a database file)
+        config["database"] = f'file:{config["database"]}?mode=memory&cache=shared'
+    else:
+        # Store the database in a temporary directory owned by this session,
+        #  so that runs in parallel or left over files do not collide
+        db_dir = tmp_path_factory.mktemp("db")
+        config["database"] = str(db_dir / Path(config["database"]).name)
+
     return config
 
 
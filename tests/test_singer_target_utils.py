@@ -0,0 +1,162 @@
+import pytest
+
+from target_sqlite.utils.singer_target_utils import (
+    COMPLEX_SCHEMA_KEYWORDS,
+    compile_record_flattener,
+    flatten_record,
+    flatten_schema,
+    simple_record_check,
+)
+
+SIMPLE_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "id": {"type": "integer"},
+        "name": {"type": ["null", "string"]},
+        "score": {"type": "number"},
+        "tags": {"type": "array"},
+    },
+    "required": ["id"],
+}
+
+
+class TestSimpleRecordCheck:
+    def test_valid_record(self):
+        check = simple_record_check(SIMPLE_SCHEMA)
+
+        assert check({"id": 1, "name": None, "score": 1, "tags": []})
+        assert check({"id": 1, "name": "a", "score": 1.5})
+
+    def test_invalid_record(self):
+        check = simple_record_check(SIMPLE_SCHEMA)
+
+        # Type mismatches
+        assert not check({"id": "1"})
+        assert not check({"id": 1, "name": 2})
+        assert not check({"id": 1, "tags": {}})
+        # Missing required property
+        assert not check({"name": "a"})
+        # Not an object
+        assert not check([{"id": 1}])
+
+    @pytest.mark.parametrize("keyword", sorted(COMPLEX_SCHEMA_KEYWORDS))
+    def test_complex_keyword_in_property(self, keyword):
+        schema = {
+            "type": "object",
+            "properties": {"attr": {"type": "array", keyword: True}},
+        }
+
+        assert simple_record_check(schema) is None
+
+    @pytest.mark.parametrize(
+        "keyword",
+        sorted(COMPLEX_SCHEMA_KEYWORDS - {"properties", "required"}),
+    )
+    def test_complex_keyword_in_schema(self, keyword):
+        schema = {**SIMPLE_SCHEMA, keyword: True}
+
+        assert simple_record_check(schema) is None
+
+    def test_unique_items(self):
+        schema = {
+            "type": "object",
+            "properties": {"tags": {"type": "array", "uniqueItems": True}},
+        }
+
+        assert simple_record_check(schema) is None
+
+
+class TestFlattenRecord:
+    def test_nested_objects(self):
+        record = {"x": {"p": 1}, "y": 2, "z": {"q": {"r": 3}, "s": [1, 2]}}
+
+        flat_record = flatten_record(record, {})
+
+        # The attributes are flattened in the order they appear in the record
+        assert list(flat_record.items()) == [
+            ("x__p", 1),
+            ("y", 2),
+            ("z__q__r", 3),
+            ("z__s", "[1, 2]"),
+        ]
+
+    def test_objects_defined_in_schema(self):
+        record = {"id": 1, "info": {"a": 1}, "tags": ["a"]}
+
+        flat_record = flatten_record(record, {"id": {}, "info": {}})
+
+        assert flat_record == {"id": 1, "info": '{"a": 1}', "tags": '["a"]'}
+
+    def test_column_name_collision(self):
+        # The last attribute flattened to the same column name wins
+        assert flatten_record({"a": {"b": 1}, "a__b": 2}, {}) == {"a__b": 2}
+        assert flatten_record({"a__b": 2, "a": {"b": 1}}, {}) == {"a__b": 1}
+
+
+NESTED_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "id": {"type": "integer"},
+        "info": {
+            "type": "object",
+            "properties": {
+                "name": {"type": "string"},
+                "location": {
+                    "type": "object",
+                    "properties": {"city": {"type": "string"}},
+                },
+                "tags": {"type": "array"},
+            },
+        },
+        "extra": {"type": "object"},
+        "items": {"type": "array"},
+        "camelCase": {"type": "string"},
+    },
+}
+
+
+class TestCompileRecordFlattener:
+    @pytest.mark.parametrize(
+        "record",
+        [
+            # Nested objects, arrays and an object column without properties
+            {
+                "id": 1,
+                "info": {
+                    "name": "a",
+                    "location": {"city": "b"},
+                    "tags": ["x", {"y": 1}],
+                },
+                "extra": {"any": {"thing": 1}},
+                "items": [1, 2],
+                "camelCase": "c",
+            },
+            # The top level timestamp column and attributes not in the schema
+            {"id": 2, "__loaded_at": "2020-01-01", "other": {"a": 1}},
+            # Missing attributes and empty objects
+            {"id": 3, "info": {}},
+            {"id": 4, "info": {"location": {}}},
+            # Values that are not objects at the paths of objects
+            {"id": 5, "info": "not an object"},
+            {"id": 6, "info": {"location": [1, 2], "name": None}},
+            {"id": 7, "info": None, "extra": "text", "items": {"a": 1}},
+            # Attributes stored in a column once their names are inflected
+            {"ID": 8},
+            {"id": 9, "Info": {"name": "y"}},
+            {"id": 10, "info": {"Name": "y", "location": {"City": "z"}}},
+            {"id": 11, "camel_case": "c", "camelCase": "d"},
+            {"id": 12, "camelCase": "d", "camel_case": "c"},
+            {"id": 13, "info": {"name": "a"}, "info__name": "b"},
+        ],
+    )
+    def test_same_as_flatten_record(self, record):
+        columns = (*flatten_schema(NESTED_SCHEMA), "__loaded_at")
+        flatten = compile_record_flattener(NESTED_SCHEMA, columns)
+
+        expected = {
+            column: value
+            for column, value in flatten_record(record, columns).items()
+            if column in columns
+        }
+
+        assert flatten(record) == expected
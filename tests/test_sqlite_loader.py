@@ -209,6 +209,12 @@ def test_data_upsert():
 
 
 class TestSQLiteLoader:
+    def rows(self, loader, data):
+        """Convert records to rows in the order expected by loader.load()"""
+        return [
+            tuple(record[name] for name in loader.attribute_names()) for record in data
+        ]
+
     def test_connection(self, config, test_table):
         loader = SQLiteLoader(table=test_table, config=config)
 
@@ -256,7 +262,7 @@ class TestSQLiteLoader:
         loader.schema_apply()
 
         # Load initial data (all inserts)
-        loader.load(test_data)
+        loader.load(self.rows(loader, test_data))
 
         # Check that the correct number of rows were inserted
         query = select(func.count()).select_from(test_table)
@@ -273,7 +279,7 @@ class TestSQLiteLoader:
             assert results[0] == 4
 
         # Test Upserting Data (8 updates && 2 inserts)
-        loader.load(test_data_upsert)
+        loader.load(self.rows(loader, test_data_upsert))
 
         query3 = (
             select(func.count())
@@ -294,7 +300,72 @@ class TestSQLiteLoader:
         # Wrap Up the test by destroying the Table created
         test_table.drop(loader.engine)
 
-    def test_wal(self, test_table, config):
+    def test_load_existing_table_without_primary_key(self, config):
+        # A table created before the stream had key properties
+        table = Table(
+            "TEST_TABLE_NO_PK",
+            MetaData(),
+            Column("id", BigInteger),
+            Column("str_attr", String),
+        )
+        loader = SQLiteLoader(table=table, config=config)
+        loader.schema_apply()
+        loader.load([(1, "a")])
+
+        try:
+            table_with_pk = Table(
+                "TEST_TABLE_NO_PK",
+                MetaData(),
+                Column("id", BigInteger, primary_key=True),
+                Column("str_attr", String),
+            )
+            loader = SQLiteLoader(table=table_with_pk, config=config)
+            loader.schema_apply()
+
+            # Records can not be UPSERTed without a primary key, so they are
+            #  appended to the existing table
+            loader.load([(1, "b"), (2, "c")])
+
+            query = select(func.count()).select_from(table)
+            with loader.engine.connect() as connection:
+                assert connection.execute(query).scalar() == 3
+        finally:
+            table.drop(loader.engine)
+
+    def test_load_existing_table_with_other_primary_key(self, config):
+        table = Table(
+            "TEST_TABLE_OTHER_PK",
+            MetaData(),
+            Column("id", BigInteger, primary_key=True),
+            Column("id2", String),
+        )
+        loader = SQLiteLoader(table=table, config=config)
+        loader.schema_apply()
+
+        try:
+            table_with_other_pk = Table(
+                "TEST_TABLE_OTHER_PK",
+                MetaData(),
+                Column("id", BigInteger),
+                Column("id2", String, primary_key=True),
+            )
+            loader = SQLiteLoader(table=table_with_other_pk, config=config)
+            loader.schema_apply()
+
+            # Records can not be UPSERTed on a different primary key, so they
+            #  are INSERTed to the existing table
+            loader.load([(1, "a"), (2, "a")])
+
+            query = select(func.count()).select_from(table)
+            with loader.engine.connect() as connection:
+                assert connection.execute(query).scalar() == 2
+        finally:
+            table.drop(loader.engine)
+
+    def test_wal(self, test_table, config, tmp_path):
+        # WAL requires a database stored in a file, even if the tests are run
+        #  with an in memory database
+        config = {**config, "database": str(tmp_path / "test_wal")}
         loader = SQLiteLoader(table=test_table, config=config)
 
         # any connection should trigger the `first_connect` hook
@@ -303,3 +374,13 @@ class TestSQLiteLoader:
         with loader.engine.connect() as connection:
             journal_mode = connection.scalar(text("PRAGMA journal_mode"))
             assert journal_mode == "wal"
+
+    def test_pragmas(self, test_table, config):
+        loader = SQLiteLoader(table=test_table, config=config)
+
+        with loader.engine.connect() as connection:
+            # synchronous=NORMAL
+            assert connection.scalar(text("PRAGMA synchronous")) == 1
+            # temp_store=MEMORY
+            assert connection.scalar(text("PRAGMA temp_store")) == 2
+            assert connection.scalar(text("PRAGMA cache_size")) == -262144
@@ -1,26 +1,372 @@
+import functools
+import json
 import pytest
 import os
+import sys
 
 from jsonschema import ValidationError
-from sqlalchemy import create_engine, inspect, text
+from sqlalchemy import inspect, text
 
+from target_sqlite.sqlite_loader import get_database_path, get_engine
 from target_sqlite.target_sqlite import TargetSQLite
 
 
+@functools.lru_cache(maxsize=None)
 def load_stream(filename):
+    """Read the lines of a test stream, cached for all the tests using it"""
     myDir = os.path.dirname(os.path.abspath(__file__))
     stream = os.path.join(myDir, "data_files", filename)
-    with open(stream) as f:
-        return [line for line in f]
+    with open(stream, buffering=1 << 16) as f:
+        return tuple(f)
+
+
+def schema_message(stream, properties, key_properties=("id",)):
+    """Build the line of a SCHEMA message for an object with the properties"""
+    return json.dumps(
+        {
+            "type": "SCHEMA",
+            "stream": stream,
+            "schema": {"type": "object", "properties": properties},
+            "key_properties": list(key_properties),
+        }
+    )
+
+
+def record_message(stream, record):
+    """Build the line of a RECORD message"""
+    return json.dumps({"type": "RECORD", "stream": stream, "record": record})
 
 
-@pytest.fixture(scope="class")
+@pytest.fixture(scope="session")
 def sqlite_engine(config):
-    db_file = f'{config["database"]}.db'
-    try:
-        yield create_engine(f"sqlite:///{db_file}", future=True)
-    finally:
-        os.remove(db_file)
+    # The database is stored in a temporary directory (or in memory) for the
+    #  whole session and each test drops the tables it creates
+    return get_engine(get_database_path(config))
+
+
+# Queries used for checking the loaded data, built once for all the tests
+OBJECT_WITH_PROPERTIES_QUERY = text(
+    "SELECT COUNT(*) "
+    " FROM test_object_schema_with_properties "
+    " WHERE object_store__id = 1 AND object_store__metric = 187"
+)
+
+OBJECT_NO_PROPERTIES_QUERY = text("""
+    SELECT COUNT(*)
+    FROM test_object_schema_no_properties
+    WHERE object_store = '{"id": 1, "metric": 1}'
+""")
+
+ARRAY_SIZES_QUERY = text("""
+    SELECT json_array_length(fruits) AS size
+    FROM test_carts
+    ORDER BY id
+""")
+
+# The queries counting the rows of each set of tables checked
+_count_stmts = {}
+
+
+def count_statement(tables):
+    """Get a query returning the (table, number of rows) for each table"""
+    tables = tuple(tables)
+    if tables not in _count_stmts:
+        _count_stmts[tables] = text(
+            " UNION ALL ".join(
+                f"SELECT '{table}', COUNT(*) FROM {table}" for table in tables
+            )
+        )
+
+    return _count_stmts[tables]
+
+
+def drop_tables(sqlite_engine, target):
+    """Drop all the tables created by the target in a single transaction"""
+    with sqlite_engine.begin() as connection:
+        for loader in target.loaders.values():
+            connection.execute(text(f"DROP TABLE IF EXISTS {loader.table.name}"))
+
+
+def check_camelcase(config, sqlite_engine):
+    # We also need to test that the record has data in the camelcased field
+    #  and that the timestamp column has been set by SQLite
+    with sqlite_engine.connect() as connection:
+        item_query = text(
+            f"SELECT client_name, {config['timestamp_column']} FROM test_camelcase"
+        )
+        item_result = connection.execute(item_query).fetchone()
+        assert item_result[0] == "Gitter Windows Desktop App"
+        assert item_result[1] is not None
+
+
+def check_schema_no_properties(config, sqlite_engine):
+    # We also need to test that the proper data records were stored
+    with sqlite_engine.connect() as connection:
+        result = connection.execute(OBJECT_WITH_PROPERTIES_QUERY).fetchone()
+        assert result[0] == 1
+
+        result = connection.execute(OBJECT_NO_PROPERTIES_QUERY).fetchone()
+        assert result[0] == 1
+
+
+def check_array_data(config, sqlite_engine):
+    # We also need to test that the proper data records were stored
+    with sqlite_engine.connect() as connection:
+        result = connection.execute(ARRAY_SIZES_QUERY).fetchall()
+        assert result[0][0] == 3
+        assert result[1][0] == 2
+        assert result[2][0] == 1
+        assert result[3][0] == 4
+
+
+# The expected results of the integration tests, by name
+# The expected columns do not include the timestamp column, which is added
+#  to every table by the Target (see the expected_results fixture)
+EXPECTED_RESULTS = {
+    "camelcase": {
+        "state": None,
+        "tables": ["test_camelcase"],
+        "columns": {"test_camelcase": ["id", "client_name"]},
+        "total_records": {"test_camelcase": 2},
+    },
+    "special_chars_in_attributes": {
+        "state": None,
+        "tables": ["test_special_chars_in_attributes"],
+        "columns": {
+            "test_special_chars_in_attributes": [
+                "_id",
+                "d__env",
+                "d__agent_type",
+                "d__agent_os_version",
+            ]
+        },
+        "total_records": {"test_special_chars_in_attributes": 1},
+    },
+    "optional_attributes": {
+        "state": {"test_optional_attributes": 4},
+        "tables": ["test_optional_attributes"],
+        "columns": {"test_optional_attributes": ["id", "optional"]},
+        "total_records": {"test_optional_attributes": 4},
+    },
+    "schema_no_properties": {
+        "state": None,
+        "tables": [
+            "test_object_schema_with_properties",
+            "test_object_schema_no_properties",
+        ],
+        "columns": {
+            "test_object_schema_with_properties": [
+                "object_store__id",
+                "object_store__metric",
+            ],
+            "test_object_schema_no_properties": ["object_store"],
+        },
+        "total_records": {
+            "test_object_schema_with_properties": 2,
+            "test_object_schema_no_properties": 2,
+        },
+    },
+    "schema_updates": {
+        "state": {"test_schema_updates": 6},
+        "tables": ["test_schema_updates"],
+        "columns": {
+            "test_schema_updates": [
+                "id",
+                "a1",
+                "a2",
+                "a3",
+                "a4__id",
+                "a4__value",
+                "a5",
+                "a6",
+            ]
+        },
+        "total_records": {"test_schema_updates": 6},
+    },
+    "duplicate_records": {
+        "state": {"test_duplicate_records": 2},
+        "tables": ["test_duplicate_records"],
+        "columns": {"test_duplicate_records": ["id", "metric"]},
+        "total_records": {"test_duplicate_records": 2},
+    },
+    "array_data": {
+        "state": {"test_carts": 4},
+        "tables": ["test_carts"],
+        "columns": {"test_carts": ["id", "fruits"]},
+        "total_records": {"test_carts": 4},
+    },
+    "encoded_string_data": {
+        "state": {
+            "test_strings": 11,
+            "test_strings_in_objects": 11,
+            "test_strings_in_arrays": 6,
+        },
+        "tables": [
+            "test_strings",
+            "test_strings_in_objects",
+            "test_strings_in_arrays",
+        ],
+        "columns": {
+            "test_strings": ["id", "info"],
+            "test_strings_in_objects": ["id", "info__name", "info__value"],
+            "test_strings_in_arrays": ["id", "strings"],
+        },
+        "total_records": {
+            "test_strings": 11,
+            "test_strings_in_objects": 11,
+            "test_strings_in_arrays": 6,
+        },
+    },
+    "multiple_state_messages": {
+        "state": {
+            "test_multiple_state_messages_a": 5,
+            "test_multiple_state_messages_b": 6,
+        },
+        "tables": [
+            "test_multiple_state_messages_a",
+            "test_multiple_state_messages_b",
+        ],
+        "columns": {
+            "test_multiple_state_messages_a": ["id", "metric"],
+            "test_multiple_state_messages_b": ["id", "metric"],
+        },
+        "total_records": {
+            "test_multiple_state_messages_a": 6,
+            "test_multiple_state_messages_b": 6,
+        },
+    },
+    "relational_data": {
+        "state": {"test_users": 5, "test_locations": 3, "test_user_in_location": 3},
+        "tables": ["test_users", "test_locations", "test_user_in_location"],
+        "columns": {
+            "test_users": ["id", "name"],
+            "test_locations": ["id", "name"],
+            "test_user_in_location": [
+                "id",
+                "user_id",
+                "location_id",
+                "info__weather",
+                "info__mood",
+            ],
+        },
+        "total_records": {
+            "test_users": 5,
+            "test_locations": 3,
+            "test_user_in_location": 3,
+        },
+    },
+    # Updating already available rows and inserting a couple new rows
+    "relational_data_upsert": {
+        "state": {"test_users": 13, "test_locations": 8, "test_user_in_location": 14},
+        "tables": ["test_users", "test_locations", "test_user_in_location"],
+        "columns": {
+            "test_users": ["id", "name"],
+            "test_locations": ["id", "name"],
+            "test_user_in_location": [
+                "id",
+                "user_id",
+                "location_id",
+                "info__weather",
+                "info__mood",
+            ],
+        },
+        "total_records": {
+            "test_users": 8,
+            "test_locations": 5,
+            "test_user_in_location": 5,
+        },
+    },
+    "no_primary_keys": {
+        "state": {"test_no_pk": 3},
+        "tables": ["test_no_pk"],
+        "columns": {"test_no_pk": ["id", "metric"]},
+        "total_records": {"test_no_pk": 3},
+    },
+    # The Total Records in this case should be 8 (5+3) due to the records
+    #  being appended and not UPSERTed
+    "no_primary_keys_append": {
+        "state": {"test_no_pk": 5},
+        "tables": ["test_no_pk"],
+        "columns": {"test_no_pk": ["id", "metric"]},
+        "total_records": {"test_no_pk": 8},
+    },
+}
+
+# Integration tests that run a single stream file through the Target:
+#  (stream file, EXPECTED_RESULTS name, optional post_check(config, sqlite_engine))
+INTEGRATION_SCENARIOS = [
+    pytest.param(
+        "camelcase.stream",
+        "camelcase",
+        check_camelcase,
+        id="camelcase",
+        marks=pytest.mark.slow,
+    ),
+    pytest.param(
+        "special_chars_in_attributes.stream",
+        "special_chars_in_attributes",
+        None,
+        id="special_chars_in_attributes",
+        marks=pytest.mark.slow,
+    ),
+    pytest.param(
+        "optional_attributes.stream",
+        "optional_attributes",
+        None,
+        id="optional_attributes",
+        marks=pytest.mark.slow,
+    ),
+    pytest.param(
+        "schema_no_properties.stream",
+        "schema_no_properties",
+        check_schema_no_properties,
+        id="schema_no_properties",
+        marks=pytest.mark.slow,
+    ),
+    pytest.param(
+        "schema_updates.stream",
+        "schema_updates",
+        None,
+        id="schema_updates",
+        marks=pytest.mark.slow,
+    ),
+    pytest.param(
+        "duplicate_records.stream", "duplicate_records", None, id="duplicate_records"
+    ),
+    pytest.param(
+        "array_data.stream",
+        "array_data",
+        check_array_data,
+        id="array_data",
+        marks=pytest.mark.slow,
+    ),
+    pytest.param(
+        "encoded_strings.stream",
+        "encoded_string_data",
+        None,
+        id="encoded_string_data",
+        marks=pytest.mark.slow,
+    ),
+]
+
+
+@pytest.fixture(scope="session")
+def expected_results(config):
+    """
+    Get EXPECTED_RESULTS with the timestamp column added to every table
+
+    Built once for the whole session, so tests must not change them.
+    """
+    return {
+        name: {
+            **expected,
+            "columns": {
+                table: [*columns, config["timestamp_column"]]
+                for table, columns in expected["columns"].items()
+            },
+        }
+        for name, expected in EXPECTED_RESULTS.items()
+    }
 
 
 class TestTargetSQLite:
@@ -55,12 +401,14 @@ class TestTargetSQLite:
         assert "id" in str(excinfo.value)
 
         # Drop the Test Tables
-        for stream, loader in target.loaders.items():
-            loader.table.drop(loader.engine)
+        drop_tables(sqlite_engine, target)
 
-    def test_record_missing_required_property(self, config, sqlite_engine):
+    @pytest.mark.parametrize("fast_validation", [True, False])
+    def test_record_missing_required_property(
+        self, config, sqlite_engine, fast_validation
+    ):
         test_stream = "record_missing_required_property.stream"
-        target = TargetSQLite(config)
+        target = TargetSQLite({**config, "fast_validation": fast_validation})
         stream = load_stream(test_stream)
 
         with pytest.raises(ValidationError) as excinfo:
@@ -69,381 +417,199 @@ class TestTargetSQLite:
         assert "'id' is a required property" in str(excinfo.value)
 
         # Drop the Test Tables
-        for stream, loader in target.loaders.items():
-            loader.table.drop(loader.engine)
-
-    @pytest.mark.slow
-    def test_camelcase(self, config, sqlite_engine):
-        # The expected results to compare
-        expected_results = {
-            "state": None,
-            "tables": ["test_camelcase"],
-            "columns": {
-                "test_camelcase": ["id", "client_name", config["timestamp_column"]]
-            },
-            "total_records": {"test_camelcase": 2},
-        }
+        drop_tables(sqlite_engine, target)
 
-        test_stream = "camelcase.stream"
-
-        self.integration_test(
-            config, sqlite_engine, expected_results, test_stream, drop_schema=False
-        )
-
-        # We also need to test that the record has data in the camelcased field
-        with sqlite_engine.begin() as connection:
-            item_query = text("SELECT client_name FROM test_camelcase")
-            item_result = connection.execute(item_query).fetchone()
-            assert item_result[0] == "Gitter Windows Desktop App"
-
-    @pytest.mark.slow
-    def test_special_chars_in_attributes(self, config, sqlite_engine):
-        # The expected results to compare
-        expected_results = {
-            "state": None,
-            "tables": ["test_special_chars_in_attributes"],
-            "columns": {
-                "test_special_chars_in_attributes": [
-                    "_id",
-                    "d__env",
-                    "d__agent_type",
-                    "d__agent_os_version",
-                    config["timestamp_column"],
-                ]
-            },
-            "total_records": {"test_special_chars_in_attributes": 1},
-        }
+    def test_error_message_for_bytes_line(self, config):
+        target = TargetSQLite(config)
+        line = '{"stream": "test_bytes", "name": "\u00e9"}\n'.encode()
 
-        test_stream = "special_chars_in_attributes.stream"
+        with pytest.raises(Exception) as excinfo:
+            target.process_line(line)
 
-        self.integration_test(config, sqlite_engine, expected_results, test_stream)
+        # The line is shown as text, not as the repr of bytes
+        message = str(excinfo.value)
+        assert message.startswith("Line is missing required key 'type': {")
+        assert '"name": "\u00e9"' in message
 
-    @pytest.mark.slow
-    def test_optional_attributes(self, config, sqlite_engine):
-        # The expected results to compare
-        expected_results = {
-            "state": {"test_optional_attributes": 4},
-            "tables": ["test_optional_attributes"],
-            "columns": {
-                "test_optional_attributes": [
-                    "id",
-                    "optional",
-                    config["timestamp_column"],
-                ]
-            },
-            "total_records": {"test_optional_attributes": 4},
+    def test_key_property_not_a_column(self, config, sqlite_engine):
+        target = TargetSQLite(config)
+        properties = {
+            "id": {"anyOf": [{"type": "integer"}, {"type": "null"}]},
+            "name": {"type": "string"},
         }
 
-        test_stream = "optional_attributes.stream"
+        with pytest.raises(ValidationError) as excinfo:
+            target.process_line(schema_message("test_key_not_a_column", properties))
+        assert "Key properties ['id']" in str(excinfo.value)
 
-        self.integration_test(config, sqlite_engine, expected_results, test_stream)
+        # The table is not created for the invalid schema
+        assert "test_key_not_a_column" not in inspect(sqlite_engine).get_table_names()
 
-    @pytest.mark.slow
-    def test_schema_no_properties(self, config, sqlite_engine):
-        # The expected results to compare
-        expected_results = {
-            "state": None,
-            "tables": [
-                "test_object_schema_with_properties",
-                "test_object_schema_no_properties",
-            ],
-            "columns": {
-                "test_object_schema_with_properties": [
-                    "object_store__id",
-                    "object_store__metric",
-                    config["timestamp_column"],
-                ],
-                "test_object_schema_no_properties": [
-                    "object_store",
-                    config["timestamp_column"],
-                ],
-            },
-            "total_records": {
-                "test_object_schema_with_properties": 2,
-                "test_object_schema_no_properties": 2,
-            },
-        }
+    def test_fast_validation_skips_validator(self, config, sqlite_engine):
+        target = TargetSQLite(config)
+        properties = {"id": {"type": "integer"}, "name": {"type": "string"}}
+        target.process_line(schema_message("test_fast_validation", properties))
 
-        test_stream = "schema_no_properties.stream"
+        class FailingValidator:
+            def iter_errors(self, record):
+                raise AssertionError("The full validator should not be used")
 
-        self.integration_test(
-            config, sqlite_engine, expected_results, test_stream, drop_schema=False
-        )
+        target.validators["test_fast_validation"] = FailingValidator()
 
-        # We also need to test that the proper data records were stored
-        with sqlite_engine.connect() as connection:
-            query = text(
-                "SELECT COUNT(*) "
-                " FROM test_object_schema_with_properties "
-                " WHERE object_store__id = 1 AND object_store__metric = 187"
+        try:
+            # A valid record only goes through the fast check
+            target.process_line(
+                record_message("test_fast_validation", {"id": 1, "name": "a"})
             )
-            result = connection.execute(query).fetchone()
-            assert result[0] == 1
-
-            query = text("""
-                SELECT COUNT(*)
-                FROM test_object_schema_no_properties
-                WHERE object_store = '{"id": 1, "metric": 1}'
-            """)
-            result = connection.execute(query).fetchone()
-            assert result[0] == 1
 
-        # Drop the Test Tables
-        with sqlite_engine.begin() as connection:
-            connection.execute(text("DROP TABLE test_object_schema_with_properties"))
-            connection.execute(text("DROP TABLE test_object_schema_no_properties"))
-
-    @pytest.mark.slow
-    def test_schema_updates(self, config, sqlite_engine):
-        # The expected results to compare
-        expected_results = {
-            "state": {"test_schema_updates": 6},
-            "tables": ["test_schema_updates"],
-            "columns": {
-                "test_schema_updates": [
-                    "id",
-                    "a1",
-                    "a2",
-                    "a3",
-                    "a4__id",
-                    "a4__value",
-                    "a5",
-                    "a6",
-                    config["timestamp_column"],
-                ]
-            },
-            "total_records": {"test_schema_updates": 6},
+            # While an invalid one falls back to the full validator
+            with pytest.raises(AssertionError):
+                target.process_line(
+                    record_message("test_fast_validation", {"id": 2, "name": 3})
+                )
+        finally:
+            drop_tables(sqlite_engine, target)
+
+    @pytest.mark.parametrize("fast_validation", [True, False])
+    def test_record_with_non_unique_items(self, config, sqlite_engine, fast_validation):
+        target = TargetSQLite({**config, "fast_validation": fast_validation})
+        properties = {
+            "id": {"type": "integer"},
+            "tags": {"type": "array", "uniqueItems": True},
         }
+        target.process_line(schema_message("test_unique_items", properties))
 
-        test_stream = "schema_updates.stream"
+        try:
+            with pytest.raises(ValidationError) as excinfo:
+                target.process_line(
+                    record_message("test_unique_items", {"id": 1, "tags": [1, 1]})
+                )
+            assert "has non-unique elements" in str(excinfo.value)
+        finally:
+            drop_tables(sqlite_engine, target)
 
-        self.integration_test(config, sqlite_engine, expected_results, test_stream)
+    @pytest.mark.parametrize("stream_file,name,post_check", INTEGRATION_SCENARIOS)
+    def test_integration(
+        self, config, sqlite_engine, expected_results, stream_file, name, post_check
+    ):
+        self.integration_test(
+            config,
+            sqlite_engine,
+            expected_results[name],
+            stream_file,
+            post_check=post_check,
+        )
 
     @pytest.mark.slow
-    def test_multiple_state_messages(self, capsys, config, sqlite_engine):
-        # The expected results to compare
-        expected_results = {
-            "state": {
-                "test_multiple_state_messages_a": 5,
-                "test_multiple_state_messages_b": 6,
-            },
-            "tables": [
-                "test_multiple_state_messages_a",
-                "test_multiple_state_messages_b",
-            ],
-            "columns": {
-                "test_multiple_state_messages_a": [
-                    "id",
-                    "metric",
-                    config["timestamp_column"],
-                ],
-                "test_multiple_state_messages_b": [
-                    "id",
-                    "metric",
-                    config["timestamp_column"],
-                ],
-            },
-            "total_records": {
-                "test_multiple_state_messages_a": 6,
-                "test_multiple_state_messages_b": 6,
-            },
-        }
-
+    def test_multiple_state_messages(self, config, sqlite_engine, expected_results):
         test_stream = "multiple_state_messages.stream"
 
         updated_config = {**config, "batch_size": 3}
+        emitted_states = []
         self.integration_test(
-            updated_config, sqlite_engine, expected_results, test_stream
+            updated_config,
+            sqlite_engine,
+            expected_results["multiple_state_messages"],
+            test_stream,
+            state_listener=emitted_states.append,
         )
 
         # Check that the expected State messages where flushed
-        expected_stdout = [
-            '{"test_multiple_state_messages_a": 1, "test_multiple_state_messages_b": 0}',
-            '{"test_multiple_state_messages_a": 3, "test_multiple_state_messages_b": 2}',
-            '{"test_multiple_state_messages_a": 5, "test_multiple_state_messages_b": 6}',
-            "",
+        expected_states = [
+            {"test_multiple_state_messages_a": 1, "test_multiple_state_messages_b": 0},
+            {"test_multiple_state_messages_a": 3, "test_multiple_state_messages_b": 2},
+            {"test_multiple_state_messages_a": 5, "test_multiple_state_messages_b": 6},
         ]
 
+        assert emitted_states == expected_states
+
+    def test_emit_state_to_stdout(self, capsys, config):
+        target = TargetSQLite(config)
+
+        target.emit_state({"test_stream": 1})
+        target.emit_state({"test_stream": 2})
+
         captured = capsys.readouterr()
-        assert captured.out == "\n".join(expected_stdout)
+        assert captured.out == '{"test_stream": 1}\n{"test_stream": 2}\n'
+        assert target.last_emitted_state == {"test_stream": 2}
 
-    @pytest.mark.slow
-    def test_relational_data(self, config, sqlite_engine):
-        # Start with a simple initial insert for everything
+    def test_state_without_records_is_flushed(self, capsys, monkeypatch, config):
+        target = TargetSQLite(config)
+        flushes = []
+        monkeypatch.setattr(sys.stdout, "flush", lambda: flushes.append(True))
 
-        # The expected results to compare
-        expected_results = {
-            "state": {"test_users": 5, "test_locations": 3, "test_user_in_location": 3},
-            "tables": ["test_users", "test_locations", "test_user_in_location"],
-            "columns": {
-                "test_users": ["id", "name", config["timestamp_column"]],
-                "test_locations": ["id", "name", config["timestamp_column"]],
-                "test_user_in_location": [
-                    "id",
-                    "user_id",
-                    "location_id",
-                    "info__weather",
-                    "info__mood",
-                    config["timestamp_column"],
-                ],
-            },
-            "total_records": {
-                "test_users": 5,
-                "test_locations": 3,
-                "test_user_in_location": 3,
-            },
-        }
+        target.process_line('{"type": "STATE", "value": {"test_stream": 1}}')
 
+        assert flushes
+        assert capsys.readouterr().out == '{"test_stream": 1}\n'
+
+    @pytest.mark.slow
+    def test_relational_data(self, config, sqlite_engine, expected_results):
+        # Start with a simple initial insert for everything
         test_stream = "user_location_data.stream"
 
         # We are not dropping the schema after the first integration test
         #  in order to also test UPSERTing records to SQLite
         self.integration_test(
-            config, sqlite_engine, expected_results, test_stream, drop_schema=False
+            config,
+            sqlite_engine,
+            expected_results["relational_data"],
+            test_stream,
+            drop_schema=False,
         )
 
         # And then test Upserting (Combination of Updating already available
         #   rows and inserting a couple new rows)
-        expected_results["state"] = {
-            "test_users": 13,
-            "test_locations": 8,
-            "test_user_in_location": 14,
-        }
-
-        expected_results["total_records"] = {
-            "test_users": 8,
-            "test_locations": 5,
-            "test_user_in_location": 5,
-        }
         test_stream = "user_location_upsert_data.stream"
 
         self.integration_test(
-            config, sqlite_engine, expected_results, test_stream, drop_schema=True
+            config,
+            sqlite_engine,
+            expected_results["relational_data_upsert"],
+            test_stream,
+            drop_schema=True,
         )
 
     @pytest.mark.slow
-    def test_no_primary_keys(self, config, sqlite_engine):
-        # The expected results to compare
-        expected_results = {
-            "state": {"test_no_pk": 3},
-            "tables": ["test_no_pk"],
-            "columns": {"test_no_pk": ["id", "metric", config["timestamp_column"]]},
-            "total_records": {"test_no_pk": 3},
-        }
-
+    def test_no_primary_keys(self, config, sqlite_engine, expected_results):
         test_stream = "no_primary_keys.stream"
 
         # We are not dropping the schema after the first integration test
         #  in order to also test APPENDING records when no PK is defined
         self.integration_test(
-            config, sqlite_engine, expected_results, test_stream, drop_schema=False
+            config,
+            sqlite_engine,
+            expected_results["no_primary_keys"],
+            test_stream,
+            drop_schema=False,
         )
 
         # And then test Upserting
         # The Total Records in this case should be 8 (5+3) due to the records
         #  being appended and not UPSERTed
-        expected_results["state"] = {"test_no_pk": 5}
-        expected_results["total_records"] = {"test_no_pk": 8}
-
         test_stream = "no_primary_keys_append.stream"
 
-        self.integration_test(
-            config, sqlite_engine, expected_results, test_stream, drop_schema=True
-        )
-
-    def test_duplicate_records(self, config, sqlite_engine):
-        # The expected results to compare
-        expected_results = {
-            "state": {"test_duplicate_records": 2},
-            "tables": ["test_duplicate_records"],
-            "columns": {
-                "test_duplicate_records": ["id", "metric", config["timestamp_column"]]
-            },
-            "total_records": {"test_duplicate_records": 2},
-        }
-
-        test_stream = "duplicate_records.stream"
-
-        self.integration_test(config, sqlite_engine, expected_results, test_stream)
-
-    @pytest.mark.slow
-    def test_array_data(self, config, sqlite_engine):
-        # The expected results to compare
-        expected_results = {
-            "state": {"test_carts": 4},
-            "tables": ["test_carts"],
-            "columns": {"test_carts": ["id", "fruits", config["timestamp_column"]]},
-            "total_records": {"test_carts": 4},
-        }
-
-        test_stream = "array_data.stream"
-
         self.integration_test(
             config,
             sqlite_engine,
-            expected_results,
+            expected_results["no_primary_keys_append"],
             test_stream,
-            drop_schema=False,
+            drop_schema=True,
         )
 
-        # We also need to test that the proper data records were stored
-        with sqlite_engine.connect() as connection:
-            query = text("""
-                SELECT json_array_length(fruits) AS size
-                FROM test_carts
-                ORDER BY id
-            """)
-            result = connection.execute(query).fetchall()
-            assert result[0][0] == 3
-            assert result[1][0] == 2
-            assert result[2][0] == 1
-            assert result[3][0] == 4
-
-        # Drop the Test Table
-        with sqlite_engine.begin() as connection:
-            connection.execute(text("DROP TABLE test_carts"))
-
-    @pytest.mark.slow
-    def test_encoded_string_data(self, config, sqlite_engine):
-        # The expected results to compare
-        expected_results = {
-            "state": {
-                "test_strings": 11,
-                "test_strings_in_objects": 11,
-                "test_strings_in_arrays": 6,
-            },
-            "tables": [
-                "test_strings",
-                "test_strings_in_objects",
-                "test_strings_in_arrays",
-            ],
-            "columns": {
-                "test_strings": ["id", "info", config["timestamp_column"]],
-                "test_strings_in_objects": [
-                    "id",
-                    "info__name",
-                    "info__value",
-                    config["timestamp_column"],
-                ],
-                "test_strings_in_arrays": ["id", "strings", config["timestamp_column"]],
-            },
-            "total_records": {
-                "test_strings": 11,
-                "test_strings_in_objects": 11,
-                "test_strings_in_arrays": 6,
-            },
-        }
-
-        test_stream = "encoded_strings.stream"
-
-        self.integration_test(config, sqlite_engine, expected_results, test_stream)
-
     def integration_test(
-        self, config, sqlite_engine, expected, stream_file, drop_schema=True
+        self,
+        config,
+        sqlite_engine,
+        expected,
+        stream_file,
+        drop_schema=True,
+        post_check=None,
+        state_listener=None,
     ):
         try:
             # Create the TargetSQLite and fully run it using the user_location_data
-            target = TargetSQLite(config)
+            target = TargetSQLite(config, state_listener=state_listener)
 
             stream = load_stream(stream_file)
 
@@ -455,33 +621,46 @@ class TestTargetSQLite:
             # Check that the final state is the expected one
             assert target.last_emitted_state == expected["state"]
 
-            # Check that the requested schema has been created
-            inspector = inspect(sqlite_engine)
-
-            all_table_names = inspector.get_table_names()
-
             with sqlite_engine.begin() as connection:
+                # Check that the requested schema has been created, reflecting
+                #  all the tables through the same connection
+                inspector = inspect(connection)
+
+                all_table_names = inspector.get_table_names()
                 for table in expected["tables"]:
                     # Check that the Table has been created in SQLite
                     assert table in all_table_names
 
+                all_columns = {
+                    table: [
+                        column["name"].lower()
+                        for column in inspector.get_columns(table)
+                    ]
+                    for table in expected["tables"]
+                }
+
+                for table in expected["tables"]:
                     # Check that the Table created has the requested attributes
-                    db_columns = []
-                    columns = inspector.get_columns(table)
-                    for column in columns:
-                        db_columns.append(column["name"].lower())
-                        assert column["name"].lower() in expected["columns"][table]
+                    db_columns = all_columns[table]
+                    for column in db_columns:
+                        assert column in expected["columns"][table]
 
                     for column in expected["columns"][table]:
                         assert column in db_columns
 
-                    # Check that the correct number of rows were inserted
-                    query = text(f"SELECT COUNT(*) FROM {table}")
+                # Check that the correct number of rows were inserted, counting
+                #  the rows of all the tables in a single query
+                query = count_statement(expected["tables"])
+                counts = dict(connection.execute(query).fetchall())
+
+                for table in expected["tables"]:
+                    assert counts[table] == expected["total_records"][table]
 
-                    results = connection.execute(query).fetchone()
-                    assert results[0] == expected["total_records"][table]
+            # Run any additional checks on the loaded data before the tables
+            #  are dropped
+            if post_check:
+                post_check(config, sqlite_engine)
         finally:
             # Drop the Test Tables
             if drop_schema:
-                for stream, loader in target.loaders.items():
-                    loader.table.drop(loader.engine)
+                drop_tables(sqlite_engine, target)